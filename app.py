@@ -1,39 +1,257 @@
+import codecs
+import heapq
+import io
 import streamlit as st
 import pandas as pd
-from collections import defaultdict
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from numba import njit
+from pydivsufsort import divsufsort, kasai
+
+@njit(cache=True)
+def _maximal_repeats(suffix_array, lcp, owner, starts, copies, codes, min_length):
+    # Walk the LCP intervals (Abouelhoda et al.). Each interval with
+    # lcp >= min_length is a right-maximal repeat occurring at SA[left..right];
+    # keep the ones that span two rows and are also left-maximal. A sentence
+    # with copies > 1 spans several rows on its own.
+    lefts = [np.int64(0) for _ in range(0)]
+    rights = [np.int64(0) for _ in range(0)]
+    lengths = [np.int64(0) for _ in range(0)]
+
+    # The bottom entry is a sentinel that is never popped.
+    stack_lcp = [0]
+    stack_left = [0]
+    n = lcp.size
+    for k in range(n + 1):
+        h = lcp[k] if k < n else 0
+        left = k
+        while h < stack_lcp[-1]:
+            length = stack_lcp.pop()
+            left = stack_left.pop()
+
+            first = owner[suffix_array[left]]
+            spans = copies[first] > 1
+            for i in range(left + 1, k + 1):
+                if owner[suffix_array[i]] != first:
+                    spans = True
+                    break
+            if not spans:
+                continue
+
+            # Skip repeats that extend to the left in every occurrence; the
+            # longer repeat is reported by its own interval.
+            left_maximal = False
+            preceding = -1
+            for i in range(left, k + 1):
+                pos = suffix_array[i]
+                if pos == starts[owner[pos]]:
+                    left_maximal = True
+                    break
+                if preceding == -1:
+                    preceding = codes[pos - 1]
+                elif codes[pos - 1] != preceding:
+                    left_maximal = True
+                    break
+            if left_maximal:
+                lefts.append(left)
+                rights.append(k)
+                lengths.append(length)
+
+        if h >= min_length and h > stack_lcp[-1]:
+            stack_lcp.append(h)
+            stack_left.append(left)
+
+    return lefts, rights, lengths
+
+def _code_points(text):
+    # Thai, Latin and digits all sit in the BMP, where UTF-16 is one unit per
+    # character; anything outside it (emoji) needs the 4-byte form to keep
+    # positions aligned with str indices.
+    encoded = text.encode("utf-16-le")
+    if len(encoded) == 2 * len(text):
+        codes = np.frombuffer(encoded, dtype=np.uint16)
+        present = np.zeros(1 << 16, dtype=bool)
+        present[codes] = True
+        rank = np.cumsum(present) - 1
+        alphabet_size = int(rank[-1]) + 1
+        dense = rank[codes]
+    else:
+        alphabet, dense = np.unique(
+            np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32), return_inverse=True
+        )
+        alphabet_size = alphabet.size
+
+    # divsufsort sorts the raw bytes of whatever it is given, so renumber the
+    # characters densely in their original order and store them in the
+    # narrowest type; a few hundred distinct characters fit in one byte. The
+    # order is kept, so the suffix array and LCP are unchanged.
+    if alphabet_size <= 1 << 8:
+        return dense.astype(np.uint8)
+    if alphabet_size <= 1 << 16:
+        return dense.astype(np.uint16)
+    return dense.astype(np.uint32)
+
+def _is_filler(seq):
+    # Runs of blanks or of one repeated character ("....", "----") match
+    # across many rows without saying anything about copied text.
+    return seq.isspace() or len(set(seq)) == 1
 
 def find_repeated_sequences(data_rows, min_length_for_search):
-    all_substrings_sources = defaultdict(set)
-
-    for original_row_idx_df, row_data in enumerate(data_rows):
-        original_csv_row_number = original_row_idx_df + 2 
-        task_id = str(row_data[0]) if len(row_data) > 0 else "N/A"
-        sentence = str(row_data[1]) if len(row_data) > 1 else ""
-        
-        if pd.isna(sentence) or len(sentence) < min_length_for_search:
-            continue
+    # data_rows holds (csv_row_number, task_id, sentence) tuples whose
+    # sentences are already at least min_length_for_search characters long.
+    if len(data_rows) < 2:
+        return {}
+
+    # Identical sentences (the same text labelled by several annotators) are
+    # searched once and fanned back out to all of their rows.
+    rows_by_sentence = {}
+    for idx, (_, _, sentence) in enumerate(data_rows):
+        rows_by_sentence.setdefault(sentence, []).append(idx)
+    sentences = list(rows_by_sentence)
+    row_groups = list(rows_by_sentence.values())
+    copies = np.fromiter(map(len, row_groups), dtype=np.int32, count=len(row_groups))
+
+    # One suffix array over the code points of all sentences, joined by a NUL
+    # sentinel, with a parallel array mapping every position back to its
+    # sentence. The joined str is only a temporary; results are sliced from
+    # the owning sentence.
+    codes = _code_points("\0".join(sentences))
+    lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+    starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+    owner = np.repeat(np.arange(len(sentences), dtype=np.int32), lengths + 1)[: codes.size]
+    remaining = ((starts + lengths)[owner] - np.arange(codes.size)).astype(np.int32)
 
-        for i in range(len(sentence) - min_length_for_search + 1):
-            for k in range(min_length_for_search, len(sentence) - i + 1):
-                sub = sentence[i : i + k]
-                source_tuple = (original_csv_row_number, task_id, sentence)
-                all_substrings_sources[sub].add(source_tuple)
+    suffix_array = divsufsort(codes)
+    # The sentinel is shared, so clip matches at sentence boundaries.
+    lcp = kasai(codes, suffix_array)[:-1]
+    lcp = np.minimum(lcp, np.minimum(remaining[suffix_array[:-1]], remaining[suffix_array[1:]]))
 
     repeated_sequences = {}
 
-    for sub_text, source_set in all_substrings_sources.items():
-        if len(source_set) > 1:
-            repeated_sequences[sub_text] = list(source_set)
-    
+    lefts, rights, repeat_lengths = _maximal_repeats(
+        suffix_array, lcp, owner, starts, copies, codes, min_length_for_search
+    )
+    for left, right, length in zip(lefts, rights, repeat_lengths):
+        positions = suffix_array[left : right + 1]
+        owners = owner[positions].tolist()
+        offset = int(positions[0] - starts[owners[0]])
+        seq = sentences[owners[0]][offset : offset + length]
+        if _is_filler(seq):
+            continue
+        repeated_sequences[seq] = [
+            data_rows[idx] for sentence_idx in dict.fromkeys(owners) for idx in row_groups[sentence_idx]
+        ]
+
+    # A duplicated sentence is itself a repeat, but with a single copy in the
+    # suffix array it only shows up above if it also occurs inside another one.
+    for sentence, group in zip(sentences, row_groups):
+        if len(group) > 1 and sentence not in repeated_sequences and not _is_filler(sentence):
+            repeated_sequences[sentence] = [data_rows[idx] for idx in group]
+
     return repeated_sequences
 
+CSV_CHUNK_ROWS = 100_000
+
+class SeqFinder:
+    # Collects searchable rows chunk by chunk, so a large CSV is never held as
+    # one DataFrame; the suffix array is built once all rows are in.
+    def __init__(self, min_length_for_search):
+        self.min_length_for_search = min_length_for_search
+        self.data_rows = []
+        self.total_rows = 0
+        self.skipped_rows = 0
+
+    def feed(self, chunk):
+        # Leading and trailing blanks cannot make a sentence long enough.
+        mask = chunk.iloc[:, 1].str.strip().str.len() >= self.min_length_for_search
+        valid = chunk[mask]
+
+        # The header line is skipped, so index + 2 is the CSV row number.
+        self.data_rows.extend(zip(
+            (valid.index + 2).tolist(),
+            valid.iloc[:, 0].tolist(),
+            valid.iloc[:, 1].tolist(),
+        ))
+        self.total_rows += len(chunk)
+        self.skipped_rows += len(chunk) - len(valid)
+
+    def finalize(self):
+        return find_repeated_sequences(self.data_rows, self.min_length_for_search)
+
+# Streamlit reruns the whole script on every widget change; cache the analysis
+# on the uploaded bytes so reruns skip it. Each entry holds a whole upload plus
+# its results, so only the last few length/file combinations are kept.
+CACHE_MAX_ENTRIES = 8
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def analyze_file(file_bytes, min_length_for_search):
+    finder = SeqFinder(min_length_for_search)
+
+    # Need a header line plus at least one data row with two columns.
+    head = pd.read_csv(io.BytesIO(file_bytes), header=None, nrows=2)
+    if head.shape[0] < 2 or head.shape[1] < 2:
+        return {}, finder.total_rows, finder.skipped_rows
+
+    # Newlines inside quoted cells make this an overestimate, which only
+    # slows the bar down.
+    total_lines = max(file_bytes.count(b"\n"), 1)
+    progress_bar = st.progress(0.0, text="Reading CSV...")
+
+    # na_filter=False reads empty cells as "" and keeps literal task IDs or
+    # sentences such as "NA" or "null" instead of turning them into NaN.
+    reader = pd.read_csv(
+        io.BytesIO(file_bytes), header=None, skiprows=1, usecols=[0, 1],
+        dtype="string[pyarrow]", na_filter=False, engine="c",
+        chunksize=CSV_CHUNK_ROWS,
+    )
+    with reader:
+        for chunk in reader:
+            finder.feed(chunk)
+            progress_bar.progress(min(finder.total_rows / total_lines, 1.0), text="Reading CSV...")
+    progress_bar.empty()
+
+    return finder.finalize(), finder.total_rows, finder.skipped_rows
+
+# Keyed on the same upload and length as analyze_file, so the CSV is only
+# serialized once per analysis; the results themselves are not hashed.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_export_csv(file_bytes, min_length_for_search, _repeated_sequences):
+    # Column-wise straight into an Arrow table; no per-row dicts or DataFrame.
+    seqs, lengths, row_numbers, task_ids, sentences = [], [], [], [], []
+    for seq, occurrences in _repeated_sequences.items():
+        seq_rows, seq_task_ids, seq_sentences = zip(*occurrences)
+        seqs.extend([seq] * len(occurrences))
+        lengths.extend([len(seq)] * len(occurrences))
+        row_numbers.extend(seq_rows)
+        task_ids.extend(seq_task_ids)
+        sentences.extend(seq_sentences)
+
+    table = pa.table({
+        "Repeated Sequence": seqs,
+        "Length of Sequence (chars)": lengths,
+        "Original CSV Row Number": row_numbers,
+        "Task ID": task_ids,
+        "Full Sentence": sentences,
+    }).sort_by([
+        ("Repeated Sequence", "ascending"),
+        ("Task ID", "ascending"),
+        ("Full Sentence", "ascending"),
+    ])
+
+    # Excel needs the BOM to read the Thai text as UTF-8.
+    buf = io.BytesIO()
+    buf.write(codecs.BOM_UTF8)
+    pa_csv.write_csv(table, buf)
+    return buf.getvalue()
+
 # --- Streamlit App ---
 st.set_page_config(layout="wide")
 st.title("⚡ Fast CSV Sentence Repetition Checker")
 
 st.markdown("""
 Upload a CSV file with columns: task ID and sentence.
-This tool detects repeated substrings across different rows.
+This tool detects the longest substrings repeated across different rows.
 """)
 
 uploaded_file = st.file_uploader("Upload your CSV file", type=["csv"])
@@ -43,51 +261,36 @@ max_preview = st.slider("How many repeated sequences to preview?", 0, 100, 10, s
 
 if uploaded_file:
     try:
-        df = pd.read_csv(uploaded_file, header=None)
-        data_to_process = []
+        file_bytes = uploaded_file.getvalue()
+        st.success("Processing...")
 
-        for index in range(1, len(df)):
-            row = df.iloc[index]
-            if len(row) >= 2:
-                data_to_process.append((row.iloc[0], row.iloc[1]))
+        with st.spinner("Finding repeated sequences..."):
+            all_found_sequences_data, total_rows, skipped_rows = analyze_file(file_bytes, user_length)
 
-        if not data_to_process:
+        if not total_rows:
             st.warning("No valid data rows found.")
         else:
-            st.success("Processing...")
-
-            with st.spinner("Finding repeated sequences..."):
-                all_found_sequences_data = find_repeated_sequences(data_to_process, user_length)
-
-            export_data = []
-            for seq, occurrences in all_found_sequences_data.items():
-                for original_csv_row_number, task_id, sentence in occurrences:
-                    export_data.append({
-                        "Repeated Sequence": seq,
-                        "Length of Sequence (chars)": len(seq),
-                        "Original CSV Row Number": original_csv_row_number,
-                        "Task ID": task_id,
-                        "Full Sentence": sentence
-                    })
-
-            if export_data:
-                export_df = pd.DataFrame(export_data)
-                export_df.sort_values(by=["Repeated Sequence", "Task ID", "Full Sentence"], inplace=True)
+            if skipped_rows:
+                st.info(f"Skipped {skipped_rows} rows with no sentence or fewer than {user_length} characters.")
 
+            if all_found_sequences_data:
                 # --- Download Button ---
                 st.download_button(
                     label="📥 Download All Results (CSV)",
-                    data=export_df.to_csv(index=False, encoding='utf-8-sig'),
+                    # Only serialized when the button is clicked.
+                    data=lambda: build_export_csv(file_bytes, user_length, all_found_sequences_data),
                     file_name=f"repeated_sequences_minlen_{user_length}.csv",
                     mime="text/csv"
                 )
 
                 # --- Optional Preview ---
                 if max_preview > 0:
-                    st.markdown(f"### 🔍 Top {max_preview} repeated sequences preview")
-                    preview_df = export_df.drop_duplicates(subset=["Repeated Sequence"]).head(max_preview)
-                    for _, row in preview_df.iterrows():
-                        st.markdown(f"- **Sequence:** `{row['Repeated Sequence']}` ({row['Length of Sequence (chars)']} chars)")
+                    # One markdown element for the whole list instead of one per line.
+                    parts = [f"### 🔍 Top {max_preview} repeated sequences preview"]
+                    # Same order as the export, but only the first few are ranked.
+                    for seq in heapq.nsmallest(max_preview, all_found_sequences_data):
+                        parts.append(f"- **Sequence:** `{seq}` ({len(seq)} chars)")
+                    st.markdown("\n".join(parts))
 
             else:
                 st.info("No repeated sequences found.")